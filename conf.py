@@ -24,6 +24,7 @@ class Settings(BaseSettings):
     max_library_caches: int = 50
     library_cache_duration: int = 24 * 3600
     library_index_refresh_interval: int = 3600
+    internet_check_cache_duration: int = 30
 
     # Max number of concurrent compile tasks
     max_concurrent_tasks: int = 10
@@ -31,6 +32,7 @@ class Settings(BaseSettings):
     # Groq config
     groq_api_key: str
     max_llm_tokens: int = 10000
+    max_concurrent_llm_requests: int = 10
 
 
 settings = Settings()
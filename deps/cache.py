@@ -1,11 +1,16 @@
 """ Code for caching compiled C++ code """
 
-from hashlib import md5
+import asyncio
+from hashlib import blake2b
+from typing import Any, Awaitable, Callable
 
 from cachetools import TTLCache
 
 from conf import settings
+from models import Sketch
 
+# Sketches and python programs share this cache, their keys are hashed with a
+# different personalization so they can never collide
 code_cache = TTLCache(
     maxsize=settings.max_code_caches, ttl=settings.code_cache_duration
 )
@@ -14,8 +19,29 @@ library_cache = TTLCache(
     maxsize=settings.max_library_caches, ttl=settings.library_cache_duration
 )
 
+# Work that is currently running, so identical requests can share the result
+inflight: dict[str, asyncio.Future] = {}
 
-def get_code_cache_key(code: str):
-    """Return a consistent md5 hash for c++ code"""
-    code = code.replace(" ", "").replace("\n", "")
-    return md5(code.encode()).hexdigest()
+
+def get_code_cache_key(sketch: Sketch):
+    """Return a consistent hash for a sketch, its board and libraries"""
+    key = blake2b(sketch.source_code.encode(), digest_size=16, person=b"sketch")
+    key.update(b"\0" + sketch.board.encode())
+    for library in sketch.libraries:
+        key.update(b"\0" + library.encode())
+    return key.hexdigest()
+
+
+def get_program_cache_key(source: bytes):
+    """Return a consistent hash for a python program, whitespace is significant here"""
+    return blake2b(source, digest_size=16, person=b"python").hexdigest()
+
+
+async def run_once(cache_key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+    """Run func, or wait for the result of an identical run that is in progress"""
+    if not (task := inflight.get(cache_key)):
+        task = asyncio.ensure_future(func())
+        inflight[cache_key] = task
+        task.add_done_callback(lambda _: inflight.pop(cache_key, None))
+    # Shield the task, so other waiters still get a result when this caller leaves
+    return await asyncio.shield(task)
@@ -0,0 +1,11 @@
+""" Python minifier job, kept free of app imports so process pool workers start quickly """
+
+import base64
+
+from python_minifier import minify
+
+
+def minify_program(code: str, filename: str) -> bytes:
+    """Minify a python program and return it base64 encoded"""
+    code = minify(code, filename=filename, remove_annotations=False)
+    return base64.b64encode(code.encode())
@@ -26,13 +26,9 @@ def get_session_id(
         session_id = uuid.uuid4().hex
         response.set_cookie("session_id", session_id)
 
-    if session_id not in compile_sessions:
-        compile_sessions[session_id] = 0
-    elif compile_sessions[session_id] >= settings.max_sessions_per_user:
+    if compile_sessions.setdefault(session_id, 0) >= settings.max_sessions_per_user:
         raise HTTPException(403, "Too many sessions.")
-
-    if session_id not in llm_tokens:
-        llm_tokens[session_id] = 0
+    llm_tokens.setdefault(session_id, 0)
 
     return session_id
 
@@ -3,25 +3,69 @@
 import asyncio
 from contextlib import asynccontextmanager
 
+import httpx
 from fastapi import FastAPI
 
 from conf import settings
 from deps.logs import logger
-from deps.utils import repeat_every, check_for_internet
+from deps.utils import ProcessPool, repeat_every, check_for_internet
+
+LIBRARY_INDEX_URL = "https://downloads.arduino.cc/libraries/library_index.tar.bz2"
+
+# Validators of the last library index that was successfully installed
+library_index_headers: dict[str, str] = {}
 
 
 @asynccontextmanager
-async def startup(_app: FastAPI) -> None:
+async def startup(app: FastAPI) -> None:
     """Startup context manager"""
-    if settings.library_index_refresh_interval > 0:
-        await refresh_library_index()
-    yield
+    # Shared by all requests, so they live as long as the app does
+    app.state.process_pool = ProcessPool(max_workers=settings.max_concurrent_tasks)
+    # Shared client, so connections to the Arduino servers are kept alive between calls
+    async with httpx.AsyncClient() as http_client:
+        app.state.http_client = http_client
+        if settings.library_index_refresh_interval > 0:
+
+            @repeat_every(
+                seconds=settings.library_index_refresh_interval, logger=logger
+            )
+            async def refresh():
+                await refresh_library_index(http_client)
 
+            await refresh()
+        yield
+    app.state.process_pool.shutdown()
 
-@repeat_every(seconds=settings.library_index_refresh_interval, logger=logger)
-async def refresh_library_index():
+
+async def _library_index_changed(
+    http_client: httpx.AsyncClient,
+) -> tuple[bool, dict[str, str]]:
+    """Check if the upstream library index changed since the last update"""
+    try:
+        response = await http_client.head(
+            LIBRARY_INDEX_URL, headers=library_index_headers, timeout=5
+        )
+    except httpx.HTTPError:
+        # Can't tell, let arduino-cli figure it out
+        return True, {}
+    if response.status_code == 304:
+        return False, library_index_headers
+
+    headers = {}
+    if etag := response.headers.get("ETag"):
+        headers["If-None-Match"] = etag
+    if last_modified := response.headers.get("Last-Modified"):
+        headers["If-Modified-Since"] = last_modified
+    return True, headers
+
+
+async def refresh_library_index(http_client: httpx.AsyncClient):
     """Update the Arduino library index"""
-    if not await check_for_internet():
+    if not await check_for_internet(http_client):
+        return
+    changed, headers = await _library_index_changed(http_client)
+    if not changed:
+        logger.debug("Library index did not change, skipping update")
         return
     logger.info("Updating library index...")
     installer = await asyncio.create_subprocess_exec(
@@ -34,5 +78,9 @@ async def refresh_library_index():
     stdout, stderr = await installer.communicate()
     if installer.returncode != 0:
         raise EnvironmentError(
-            f"Failed to update library index: {stderr.decode() + stdout.decode()}"
+            "Failed to update library index: "
+            + stderr.decode(errors="replace")
+            + stdout.decode(errors="replace")
         )
+    library_index_headers.clear()
+    library_index_headers.update(headers)
@@ -2,14 +2,21 @@
 
 import asyncio
 import logging
+import multiprocessing
 from asyncio import ensure_future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from functools import wraps
 from traceback import format_exception
-from typing import Any, Callable, Coroutine, Optional, Union
+from typing import Annotated, Any, Callable, Coroutine, Optional, Union
 
 import httpx
+from cachetools import TTLCache
+from fastapi import Depends, Request
 from starlette.concurrency import run_in_threadpool
 
+from conf import settings
+
 NoArgsNoReturnFuncT = Callable[[], None]
 NoArgsNoReturnAsyncFuncT = Callable[[], Coroutine[Any, Any, None]]
 NoArgsNoReturnDecorator = Callable[
@@ -17,6 +24,61 @@ NoArgsNoReturnDecorator = Callable[
 ]
 
 
+async def get_http_client(request: Request) -> httpx.AsyncClient:
+    """Get the http client that was created on startup"""
+    return request.app.state.http_client
+
+
+HttpClient = Annotated[httpx.AsyncClient, Depends(get_http_client)]
+
+
+class ProcessPool:
+    """Pool for CPU heavy work that would otherwise block the event loop"""
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.executor = self._create_executor()
+
+    def _create_executor(self) -> ProcessPoolExecutor:
+        if "forkserver" not in multiprocessing.get_all_start_methods():
+            # Not available on Windows, which spawns workers by default
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        # Start workers from a fork server, not by forking the threaded app process.
+        # The fork server preloads the jobs, so workers don't import them one by one.
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(["deps.minify"])
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+
+    async def run(self, func: Callable[..., Any], *args: Any) -> Any:
+        """Run func in a worker, replacing the pool if one of its workers died"""
+        executor = self.executor
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                executor, func, *args
+            )
+        except BrokenProcessPool:
+            # Only replace it once, other calls may have failed on the same pool
+            if self.executor is executor:
+                executor.shutdown(wait=False)
+                self.executor = self._create_executor()
+            raise
+
+    def shutdown(self) -> None:
+        """Shut down the worker processes"""
+        self.executor.shutdown()
+
+
+async def get_process_pool(request: Request) -> ProcessPool:
+    """Get the process pool that was created on startup"""
+    return request.app.state.process_pool
+
+
+Pool = Annotated[ProcessPool, Depends(get_process_pool)]
+
+# Successful internet checks are reused for a short while
+internet_check_cache = TTLCache(maxsize=1, ttl=settings.internet_check_cache_duration)
+
+
 def repeat_every(
     *,
     seconds: float,
@@ -89,12 +151,14 @@ def repeat_every(
     return decorator
 
 
-async def check_for_internet() -> bool:
+async def check_for_internet(http_client: httpx.AsyncClient) -> bool:
     """Check if internet connection is available"""
-    client = httpx.AsyncClient()
+    if internet_check_cache.get("available"):
+        return True
     try:
-        response = await client.get("https://downloads.arduino.cc", timeout=5)
+        response = await http_client.get("https://downloads.arduino.cc", timeout=5)
         response.raise_for_status()
     except httpx.HTTPError:
         return False
+    internet_check_cache["available"] = True
     return True
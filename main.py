@@ -3,20 +3,29 @@
 import asyncio
 import base64
 import tempfile
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import suppress
+from functools import cache, partial
 from os import path
 
-import aiofiles
+import httpx
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from groq import Groq
-from python_minifier import minify
+from groq import AsyncGroq
 
 from conf import settings
-from deps.cache import code_cache, get_code_cache_key, library_cache
+from deps.cache import (
+    code_cache,
+    get_code_cache_key,
+    get_program_cache_key,
+    library_cache,
+    run_once,
+)
 from deps.logs import logger
+from deps.minify import minify_program
 from deps.session import Session, compile_sessions, llm_tokens
 from deps.tasks import startup
-from deps.utils import check_for_internet
+from deps.utils import HttpClient, Pool, ProcessPool, check_for_internet
 from models import Sketch, Library, PythonProgram, Messages
 
 app = FastAPI(lifespan=startup)
@@ -28,39 +37,75 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
-client = Groq(api_key=settings.groq_api_key)
 
 # Limit compiler concurrency to prevent overloading the vm
 semaphore = asyncio.Semaphore(settings.max_concurrent_tasks)
+# Limit concurrent LLM requests, so a burst of them can't starve the compilers
+llm_semaphore = asyncio.Semaphore(settings.max_concurrent_llm_requests)
+# Run one library install at a time, concurrent arduino-cli installs race on shared dependencies
+install_lock = asyncio.Lock()
+
+
+# Small files are read and written in one thread hop instead of one per file operation
+def _write_file(file_path: str, content: str) -> None:
+    with open(file_path, "w", encoding="utf-8") as _f:
+        _f.write(content)
+
+
+def _read_file(file_path: str) -> bytes:
+    with open(file_path, "rb") as _f:
+        return _f.read()
+
+
+def _read_compile_output(sketch_path: str) -> dict[str, str]:
+    file_result = {}
+    with suppress(FileNotFoundError):
+        file_result["hex"] = _read_file(f"{sketch_path}.hex")
 
+    # Boards that produce both a .bin and a .uf2 are flashed with the .uf2
+    for extension in (".uf2", ".bin"):
+        with suppress(FileNotFoundError):
+            data = _read_file(f"{sketch_path}{extension}")
+            file_result["sketch"] = base64.b64encode(data).decode("utf-8")
+            break
 
-async def _install_libraries(libraries: list[Library]) -> None:
-    # Install required libraries
-    if not await check_for_internet():
+    return file_result
+
+
+async def _install_libraries(
+    libraries: list[Library], http_client: httpx.AsyncClient
+) -> None:
+    # Install required libraries that were not installed recently
+    missing = [library for library in libraries if not library_cache.get(library)]
+    if not missing:
+        return
+    if not await check_for_internet(http_client):
         logger.warning("No internet connection, skipping library install")
         return
-    for library in libraries:
-        if library_cache.get(library):
-            continue
 
-        logger.info("Installing libraries: %s", library)
+    async with install_lock:
+        # Another request may have installed them while we waited
+        missing = [library for library in missing if not library_cache.get(library)]
+        if not missing:
+            return
+
+        # Install them in a single call, so shared dependencies are resolved only once
+        logger.info("Installing libraries: %s", ", ".join(missing))
         installer = await asyncio.create_subprocess_exec(
             settings.arduino_cli_path,
             "lib",
             "install",
-            library,
+            *missing,
             stderr=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
         )
         stdout, stderr = await installer.communicate()
         if installer.returncode != 0:
-            logger.error(
-                "Failed to install library: %s", stderr.decode() + stdout.decode()
-            )
-            raise HTTPException(
-                500, f"Failed to install library: {stderr.decode() + stdout.decode()}"
-            )
-        library_cache[library] = 1
+            output = stderr.decode(errors="replace") + stdout.decode(errors="replace")
+            logger.error("Failed to install library: %s", output)
+            raise HTTPException(500, f"Failed to install library: {output}")
+        for library in missing:
+            library_cache[library] = 1
 
 
 async def _compile_sketch(sketch: Sketch) -> dict[str, str]:
@@ -69,8 +114,7 @@ async def _compile_sketch(sketch: Sketch) -> dict[str, str]:
         sketch_path = f"{dir_name}/{file_name}"
 
         # Write the sketch to a temp .ino file
-        async with aiofiles.open(sketch_path, "w+") as _f:
-            await _f.write(sketch.source_code)
+        await asyncio.to_thread(_write_file, sketch_path, sketch.source_code)
 
         compiler = await asyncio.create_subprocess_exec(
             settings.arduino_cli_path,
@@ -85,95 +129,113 @@ async def _compile_sketch(sketch: Sketch) -> dict[str, str]:
         )
         stdout, stderr = await compiler.communicate()
         if compiler.returncode != 0:
-            logger.warning("Compilation failed: %s", stderr.decode() + stdout.decode())
-            raise HTTPException(500, stderr.decode() + stdout.decode())
+            output = stderr.decode(errors="replace") + stdout.decode(errors="replace")
+            logger.warning("Compilation failed: %s", output)
+            raise HTTPException(500, output)
 
-        file_result = {}
+        return await asyncio.to_thread(_read_compile_output, sketch_path)
 
-        files = [("hex", ".hex")]
-        for file in files:
-            if path.exists(f"{sketch_path}{file[1]}"):
-                async with aiofiles.open(f"{sketch_path}{file[1]}", "rb") as _f:
-                    file_result[file[0]] = await _f.read()
 
-        binary_files = [("sketch", ".bin"), ("sketch", ".uf2")]
-        for file in binary_files:
-            if path.exists(f"{sketch_path}{file[1]}"):
-                async with aiofiles.open(f"{sketch_path}{file[1]}", "rb") as _f:
-                    file_result[file[0]] = base64.b64encode(await _f.read()).decode(
-                        "utf-8"
-                    )
-
-        return file_result
+async def _compile_and_cache(
+    sketch: Sketch, cache_key: str, http_client: httpx.AsyncClient
+) -> dict[str, str]:
+    async with semaphore:
+        await _install_libraries(sketch.libraries, http_client)
+        result = await _compile_sketch(sketch)
+        code_cache[cache_key] = result
+        return result
 
 
 @app.post("/compile/cpp")
-async def compile_cpp(sketch: Sketch, session_id: Session) -> dict[str, str]:
+async def compile_cpp(
+    sketch: Sketch, session_id: Session, http_client: HttpClient
+) -> dict[str, str]:
     """Compile code and return the result in HEX format"""
     # Make sure there's no more than X compile requests per user
     compile_sessions[session_id] += 1
 
     try:
         # Check if this code was compiled before
-        cache_key = get_code_cache_key(sketch.model_dump_json())
+        cache_key = get_code_cache_key(sketch)
         if compiled_code := code_cache.get(cache_key):
             # It was -> return cached result
             return compiled_code
 
-        # Nope -> compile and store in cache
-        async with semaphore:
-            await _install_libraries(sketch.libraries)
-            result = await _compile_sketch(sketch)
-            code_cache[cache_key] = result
-            return result
+        # Nope -> compile and store in cache, sharing the work with identical requests
+        return await run_once(
+            cache_key, partial(_compile_and_cache, sketch, cache_key, http_client)
+        )
     finally:
         compile_sessions[session_id] -= 1
 
 
+async def _minify_and_cache(
+    program: PythonProgram, code: str, cache_key: str, process_pool: ProcessPool
+) -> PythonProgram:
+    async with semaphore:
+        try:
+            program.source_code = await process_pool.run(
+                minify_program, code, program.filename
+            )
+        except BrokenProcessPool as ex:
+            logger.error("Minifier worker died: %s", ex)
+            raise HTTPException(503, "Minifier unavailable, try again") from ex
+        except Exception as ex:
+            raise HTTPException(
+                422, f"Unable to minify python program: {str(ex)}"
+            ) from ex
+        code_cache[cache_key] = program
+        return program
+
+
 @app.post("/minify/python")
-async def minify_python(program: PythonProgram, session_id: Session) -> PythonProgram:
+async def minify_python(
+    program: PythonProgram, session_id: Session, process_pool: Pool
+) -> PythonProgram:
     """Minify a python program"""
     # Make sure there's no more than X minify requests per user
     compile_sessions[session_id] += 1
     try:
         # Check if this code was minified before
         try:
-            code = base64.b64decode(program.source_code).decode()
+            source = base64.b64decode(program.source_code)
+            code = source.decode()
         except Exception as ex:
             raise HTTPException(
                 422, f"Unable to base64 decode program: {str(ex)}"
             ) from ex
 
-        cache_key = get_code_cache_key(code)
+        cache_key = get_program_cache_key(source)
         if minified_code := code_cache.get(cache_key):
             # It was -> return cached result
             return minified_code
 
-        # Nope -> minify and store in cache
-        async with semaphore:
-            try:
-                code = minify(code, filename=program.filename, remove_annotations=False)
-            except Exception as ex:
-                raise HTTPException(
-                    422, f"Unable to minify python program: {str(ex)}"
-                ) from ex
-            program.source_code = base64.b64encode(code.encode())
-            code_cache[cache_key] = program
-            return program
+        # Nope -> minify and store in cache, sharing the work with identical requests
+        return await run_once(
+            cache_key,
+            partial(_minify_and_cache, program, code, cache_key, process_pool),
+        )
     finally:
         compile_sessions[session_id] -= 1
 
 
+@cache
+def get_llm_client() -> AsyncGroq:
+    """Create the Groq client on first use, so importing the app stays cheap"""
+    return AsyncGroq(api_key=settings.groq_api_key)
+
+
 @app.post("/ai/generate")
 async def generate(messages: Messages, session_id: Session):
     """Generate message"""
     if llm_tokens[session_id] >= settings.max_llm_tokens:
         raise HTTPException(429, {"detail": "Try again later"})
 
-    response = client.chat.completions.create(
-        messages=list(map(lambda e: e.dict(), messages.messages)),
-        model="llama3-70b-8192",
-    )
+    async with llm_semaphore:
+        response = await get_llm_client().chat.completions.create(
+            messages=messages.model_dump()["messages"],
+            model="llama3-70b-8192",
+        )
     llm_tokens[session_id] += response.usage.total_tokens
 
     return response.choices[0].message.content
@@ -2,7 +2,7 @@
 
 from typing import Annotated
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, field_validator
 
 # Regex match to (hopefully) prevent weird CLI injection issues
 Library = Annotated[str, Field(pattern=r"^[a-zA-Z0-9_ \.@]*$")]
@@ -15,6 +15,12 @@ class Sketch(BaseModel):
     board: str
     libraries: list[Library] = []
 
+    @field_validator("libraries")
+    @classmethod
+    def normalize_libraries(cls, libraries: list[str]) -> list[str]:
+        """Sort and deduplicate libraries, so equal sketches share a cache key"""
+        return sorted(set(libraries))
+
 
 class PythonProgram(BaseModel):
     """Model representing a python program"""